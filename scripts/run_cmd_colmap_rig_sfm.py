@@ -1,16 +1,26 @@
 import argparse
+import itertools
 import json
 import os
 import platform
+import struct
 import subprocess
+import sys
 from pathlib import Path
 
-import numpy as np
 from loguru import logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def load_json_config(config_path):
     """Load JSON configuration file."""
+    if orjson is not None:
+        with open(config_path, "rb") as f:
+            return orjson.loads(f.read())
     with open(config_path, "r", encoding="utf-8") as f:
         return json.load(f)
 
@@ -25,14 +35,11 @@ def run_command(cmd_list):
             stderr=subprocess.STDOUT,
             text=True,
             encoding="utf-8",
+            bufsize=1 << 16,
         )
-        while True:
-            output = process.stdout.readline()
-            if output == "" and process.poll() is not None:
-                break
-            if output:
-                logger.info(output.strip())
-        rc = process.poll()
+        for line in process.stdout:
+            logger.info(line.rstrip())
+        rc = process.wait()
         if rc != 0:
             logger.error(f"Error: Command failed with exit code {rc}")
         return rc
@@ -43,43 +50,107 @@ def run_command(cmd_list):
         return -1
 
 
+def prefetch_files(database_path, image_dir):
+    """Asks the kernel to read the database and every image below ``image_dir`` into the page
+    cache ahead of time.
+
+    The mapper performs many small random reads on them, which one batched readahead avoids.
+    The image tree is only walked where posix_fadvise exists.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    image_paths = (path for path in Path(image_dir).rglob("*") if path.is_file())
+    for path in itertools.chain([database_path], image_paths):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def has_display():
+    """Returns whether a GUI can be opened from the current session."""
+    if not sys.stdout.isatty():
+        return False
+    if platform.system() in ("Windows", "Darwin"):
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
 def update_database_camera_model(database_path, camera_model="PINHOLE", camera_config=None):
     """Updates the camera model in the COLMAP database."""
     import sqlite3
 
     conn = sqlite3.connect(database_path)
+    # The database is rebuilt from scratch if the pipeline fails, so durability can be traded
+    # for fewer fsyncs.
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA journal_mode=MEMORY")
+    # Keep temporary structures and the page cache in memory and map up to 256 MiB of the
+    # file directly instead of going through read()/write() for every page.
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA mmap_size=268435456")
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM images")
-    results = cursor.fetchall()
-    name_to_id = {}
-    for row in results:
-        image_id = row[0]
-        image_name = row[1]
-        camera_id = row[2]
-        name_to_id[image_name] = camera_id
 
-    for cam in camera_config:
-        params = np.array(
-            [
-                cam["fx"],
-                cam["fy"],
-                cam["cx"],
-                cam["cy"],
-            ],
-            dtype=np.float64,
+    # COLMAP stores camera params as little-endian float64.
+    params_by_name = {
+        os.path.join(cam["image_prefix"], cam["image_name"]): struct.pack(
+            "<4d", cam["fx"], cam["fy"], cam["cx"], cam["cy"]
         )
-        cam_key = os.path.join(cam["image_prefix"], cam["image_name"])
-        camere_id = name_to_id.get(cam_key, 0)
-        cursor.execute(
-            "UPDATE cameras SET params = ? WHERE camera_id = ?",
-            (params.tobytes(), camere_id),
+        for cam in camera_config
+    }
+
+    # Only look up the configured images, in chunks that stay below SQLite's bound
+    # parameter limit.
+    names = list(params_by_name)
+    chunk_size = 500
+    name_to_id = {}
+    for start in range(0, len(names), chunk_size):
+        chunk = names[start : start + chunk_size]
+        placeholders = ",".join("?" * len(chunk))
+        name_to_id.update(
+            cursor.execute(
+                f"SELECT name, camera_id FROM images WHERE name IN ({placeholders})", chunk
+            )
         )
 
+    # Images sharing a camera would overwrite each other's params anyway, so only the last
+    # entry per camera needs to be written.
+    params_by_camera = {name_to_id.get(name, 0): params for name, params in params_by_name.items()}
+    rows = [(params, camera_id) for camera_id, params in params_by_camera.items()]
+
+    conn.execute("BEGIN IMMEDIATE")
+    cursor.executemany("UPDATE cameras SET params = ? WHERE camera_id = ?", rows)
     conn.commit()
     conn.close()
     logger.info(f"Updated camera model to '{camera_model}' in database '{database_path}'.")
 
 
+def write_rig_pairs(camera_config, pairs_path):
+    """Writes a match list pairing every rig capture i with the captures i + 2^k."""
+    captures = {}
+    for cam in camera_config:
+        image_name = f"{cam['image_prefix']}/{cam['image_name']}"
+        captures.setdefault(cam["pano_index"], []).append(image_name)
+    captures = [captures[pano_index] for pano_index in sorted(captures)]
+
+    num_pairs = 0
+    with open(pairs_path, "w", encoding="utf-8") as f:
+        for i, images1 in enumerate(captures):
+            step = 1
+            while i + step < len(captures):
+                for name1 in images1:
+                    for name2 in captures[i + step]:
+                        f.write(f"{name1} {name2}\n")
+                num_pairs += len(images1) * len(captures[i + step])
+                step *= 2
+    logger.info(f"Wrote {num_pairs} rig image pairs to '{pairs_path}'.")
+
+
 def parse_args():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description="Run COLMAP pipeline with camera rig")
@@ -100,6 +171,52 @@ def parse_args():
         choices=["PINHOLE", "SIMPLE_PINHOLE", "SIMPLE_RADIAL"],
         help="Camera model type",
     )
+    parser.add_argument(
+        "--use_gpu_ba",
+        action="store_true",
+        help="Run bundle adjustment on the GPU (needs COLMAP built with Ceres>=2.3 and cuDSS)",
+    )
+    parser.add_argument(
+        "--ba_gpu_index", type=str, default="0", help="GPU index used for bundle adjustment"
+    )
+    parser.add_argument(
+        "--matcher",
+        type=str,
+        default="rig",
+        choices=["rig", "sequential"],
+        help="Match rig captures i and i + 2^k ('rig') or run COLMAP's sequential matcher",
+    )
+    parser.add_argument(
+        "--mapper",
+        type=str,
+        default="incremental",
+        choices=["incremental", "hierarchical"],
+        help="Mapper to use; 'hierarchical' reconstructs clusters in parallel for large image sets",
+    )
+    parser.add_argument(
+        "--ba_global_max_num_iterations",
+        type=int,
+        default=20,
+        help="Maximum number of solver iterations per global bundle adjustment",
+    )
+    parser.add_argument(
+        "--ba_global_max_refinements",
+        type=int,
+        default=2,
+        help="Maximum number of global bundle adjustment refinements",
+    )
+    parser.add_argument(
+        "--ba_global_frames_freq",
+        type=int,
+        default=1000,
+        help="Run global bundle adjustment after this many newly registered frames",
+    )
+    parser.add_argument(
+        "--ba_global_points_freq",
+        type=int,
+        default=500000,
+        help="Run global bundle adjustment after this many newly triangulated points",
+    )
     parser.add_argument(
         "--visualize", action="store_true", help="Visualize the sparse reconstruction"
     )
@@ -153,14 +270,29 @@ def main():
 
     # --- 2. Feature Matching ---
     logger.info("\n--- Step 2: Feature Matching (with Camera Rig) ---")
-    cmd_matcher = [
-        COLMAP_EXE,
-        "sequential_matcher",
-        "--database_path",
-        database_path,
-        "--SequentialMatching.loop_detection",
-        "1",
-    ]
+    if args.matcher == "rig":
+        # Log-spaced capture pairs already close loops, so no vocabulary tree is needed.
+        pairs_path = workspace / "rig_pairs.txt"
+        write_rig_pairs(camera_config, pairs_path)
+        cmd_matcher = [
+            COLMAP_EXE,
+            "matches_importer",
+            "--database_path",
+            database_path,
+            "--match_list_path",
+            pairs_path,
+            "--match_type",
+            "pairs",
+        ]
+    else:
+        cmd_matcher = [
+            COLMAP_EXE,
+            "sequential_matcher",
+            "--database_path",
+            database_path,
+            "--SequentialMatching.loop_detection",
+            "1",
+        ]
     if run_command(cmd_matcher) != 0:
         return
 
@@ -180,7 +312,7 @@ def main():
     logger.info("\n--- Step 3: Scene Mapping ---")
     cmd_mapper = [
         COLMAP_EXE,
-        "mapper",
+        "hierarchical_mapper" if args.mapper == "hierarchical" else "mapper",
         "--database_path",
         database_path,
         "--image_path",
@@ -195,12 +327,27 @@ def main():
         "0",
         "--Mapper.ba_refine_sensor_from_rig",
         "0",
+        # Intrinsics and rig extrinsics are frozen, so global BA can run less often and
+        # converge in fewer iterations.
+        "--Mapper.ba_global_max_num_iterations",
+        str(args.ba_global_max_num_iterations),
+        "--Mapper.ba_global_max_refinements",
+        str(args.ba_global_max_refinements),
+        "--Mapper.ba_global_frames_freq",
+        str(args.ba_global_frames_freq),
+        "--Mapper.ba_global_points_freq",
+        str(args.ba_global_points_freq),
     ]
+    if args.use_gpu_ba:
+        cmd_mapper += ["--Mapper.ba_use_gpu", "1", "--Mapper.ba_gpu_index", args.ba_gpu_index]
+    prefetch_files(database_path, image_path)
     if run_command(cmd_mapper) != 0:
         return
 
     # Visualize if requested
-    if args.visualize:
+    if args.visualize and not has_display():
+        logger.warning("Skipping visualization: no display available in this session.")
+    elif args.visualize:
         logger.info("\n--- Step 4: Visualize Sparse Model ---")
         cmd_visualizer = [
             COLMAP_EXE,
@@ -3,6 +3,7 @@ An example for running incremental SfM on 360 spherical panorama images.
 """
 
 import argparse
+import itertools
 import json
 import os
 from pathlib import Path
@@ -11,34 +12,49 @@ import numpy as np
 import pycolmap
 from pycolmap import logging
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def read_json_config(config_path: Path) -> dict:
     """Read a JSON configuration file."""
+    if orjson is not None:
+        with open(config_path, "rb") as f:
+            return orjson.loads(f.read())
     with open(config_path, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
+def prefetch_files(database_path, image_dir):
+    """Asks the kernel to read the database and every image below ``image_dir`` into the page
+    cache ahead of time."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    image_paths = (path for path in Path(image_dir).rglob("*") if path.is_file())
+    for path in itertools.chain([database_path], image_paths):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
 def create_rig_config(
     input_rig_config: dict,
     input_camera_config: dict,
     camera_model: str = "PINHOLE",
 ) -> pycolmap.RigConfig:
     """Create a RigConfig for the given virtual rotations."""
+    camera_config_by_prefix = {}
+    for image_config in input_camera_config:
+        camera_config_by_prefix.setdefault(image_config["image_prefix"], image_config)
+
     rig_cameras = []
-    # first img
-    first_image = input_camera_config[0]
-    camera = pycolmap.Camera(
-        camera_id=0,
-        model=camera_model,
-        params=[
-            first_image["fx"],
-            first_image["fy"],
-            first_image["cx"],
-            first_image["cy"],
-        ],
-        width=first_image["width"],
-        height=first_image["height"],
-    )
     for idx, params in enumerate(input_rig_config[0]["cameras"]):
         ref_sensor = params.get("ref_sensor", False)
         if ref_sensor:
@@ -55,9 +71,23 @@ def create_rig_config(
                 "cam_from_rig": cam_from_rig,
             }
         )
-        # Create a camera for each rig camera
-        camera.camera_id = idx
-        rig_camera.camera = camera
+        # Create a camera for each rig camera from the intrinsics of its own images
+        image_config = camera_config_by_prefix[params["image_prefix"]]
+        fx, fy = image_config["fx"], image_config["fy"]
+        cx, cy = image_config["cx"], image_config["cy"]
+        if camera_model == "PINHOLE":
+            camera_params = [fx, fy, cx, cy]
+        elif camera_model == "SIMPLE_PINHOLE":
+            camera_params = [(fx + fy) / 2, cx, cy]
+        else:  # SIMPLE_RADIAL
+            camera_params = [(fx + fy) / 2, cx, cy, 0.0]
+        rig_camera.camera = pycolmap.Camera(
+            camera_id=idx,
+            model=camera_model,
+            params=camera_params,
+            width=image_config["width"],
+            height=image_config["height"],
+        )
         rig_cameras.append(rig_camera)
 
     return pycolmap.RigConfig(cameras=rig_cameras)
@@ -75,7 +105,7 @@ def run(args: argparse.Namespace) -> None:
 
     input_camera_config = read_json_config(args.input_camera_config)
     input_rig_config = read_json_config(args.input_rig_config)
-    rig_config = create_rig_config(input_rig_config, input_camera_config)
+    rig_config = create_rig_config(input_rig_config, input_camera_config, args.camera_model)
     image_names = [os.path.join(p["image_prefix"], p["image_name"]) for p in input_camera_config]
     pycolmap.set_random_seed(0)
     pycolmap.extract_features(
@@ -84,6 +114,7 @@ def run(args: argparse.Namespace) -> None:
         # image_names,
         # reader_options={"mask_path": mask_dir},
         camera_mode=pycolmap.CameraMode.PER_FOLDER,
+        camera_model=args.camera_model,
     )
 
     with pycolmap.Database(database_path) as db:
@@ -92,7 +123,11 @@ def run(args: argparse.Namespace) -> None:
     if args.matcher == "sequential":
         pycolmap.match_sequential(
             database_path,
-            matching_options=pycolmap.SequentialMatchingOptions(loop_detection=True),
+            # With the rig applied, image i is matched against all images of the rig frames
+            # i + 2^k, which already closes loops without a vocabulary tree.
+            matching_options=pycolmap.SequentialMatchingOptions(
+                quadratic_overlap=True, expand_rig_images=True, loop_detection=False
+            ),
         )
     elif args.matcher == "exhaustive":
         pycolmap.match_exhaustive(database_path)
@@ -108,7 +143,16 @@ def run(args: argparse.Namespace) -> None:
         ba_refine_focal_length=False,
         ba_refine_principal_point=False,
         ba_refine_extra_params=False,
+        # Intrinsics and rig extrinsics are frozen, so global BA can run less often and
+        # converge in fewer iterations.
+        ba_global_max_num_iterations=args.ba_global_max_num_iterations,
+        ba_global_max_refinements=args.ba_global_max_refinements,
+        ba_global_frames_freq=args.ba_global_frames_freq,
+        ba_global_points_freq=args.ba_global_points_freq,
+        ba_use_gpu=args.use_gpu_ba,
+        ba_gpu_index=args.ba_gpu_index,
     )
+    prefetch_files(database_path, input_image_path)
     recs = pycolmap.incremental_mapping(database_path, input_image_path, rec_path, opts)
     for idx, rec in recs.items():
         logging.info(f"#{idx} {rec.summary()}")
@@ -116,7 +160,8 @@ def run(args: argparse.Namespace) -> None:
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    date = "20250602010323"
+    # Default inputs/outputs live in outputs/<date>/, override the run with $OMNI_SFM_DATE.
+    date = os.environ.get("OMNI_SFM_DATE", "20250602010323")
     parser.add_argument(
         "--input_image_path",
         type=Path,
@@ -141,9 +186,48 @@ if __name__ == "__main__":
         required=False,
         default=Path(f"outputs/{date}/sfm"),
     )
+    parser.add_argument(
+        "--camera_model",
+        type=str,
+        default="PINHOLE",
+        choices=["PINHOLE", "SIMPLE_PINHOLE", "SIMPLE_RADIAL"],
+        help="Camera model type",
+    )
     parser.add_argument(
         "--matcher",
         default="sequential",
         choices=["sequential", "exhaustive", "vocabtree", "spatial"],
     )
+    parser.add_argument(
+        "--ba_global_max_num_iterations",
+        type=int,
+        default=20,
+        help="Maximum number of solver iterations per global bundle adjustment",
+    )
+    parser.add_argument(
+        "--ba_global_max_refinements",
+        type=int,
+        default=2,
+        help="Maximum number of global bundle adjustment refinements",
+    )
+    parser.add_argument(
+        "--ba_global_frames_freq",
+        type=int,
+        default=1000,
+        help="Run global bundle adjustment after this many newly registered frames",
+    )
+    parser.add_argument(
+        "--ba_global_points_freq",
+        type=int,
+        default=500000,
+        help="Run global bundle adjustment after this many newly triangulated points",
+    )
+    parser.add_argument(
+        "--use_gpu_ba",
+        action="store_true",
+        help="Run bundle adjustment on the GPU (needs pycolmap built with Ceres>=2.3 and cuDSS)",
+    )
+    parser.add_argument(
+        "--ba_gpu_index", type=str, default="0", help="GPU index used for bundle adjustment"
+    )
     run(parser.parse_args())
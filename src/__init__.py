@@ -1,5 +1,20 @@
-from .comfy_ui import NODE_CLASS_MAPPINGS, NODE_DISPLAY_NAME_MAPPINGS
-from .gradio_ui import OmniConverterUI
-from .omni_processor import OmniVideoProcessor
+import importlib
+
+# Submodules are imported on first attribute access so that, e.g., the Gradio app does not
+# pull in the ComfyUI nodes (and vice versa).
+_LAZY_ATTRS = {
+    "NODE_CLASS_MAPPINGS": ".comfy_ui",
+    "NODE_DISPLAY_NAME_MAPPINGS": ".comfy_ui",
+    "OmniConverterUI": ".gradio_ui",
+    "OmniVideoProcessor": ".omni_processor",
+}
 
 __all__ = ["NODE_CLASS_MAPPINGS", "NODE_DISPLAY_NAME_MAPPINGS"]
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    globals()[name] = value
+    return value
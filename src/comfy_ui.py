@@ -1,4 +1,7 @@
+import functools
+import json
 import os
+import subprocess
 import sys
 from pathlib import Path
 
@@ -23,6 +26,17 @@ except ImportError:
     )
 
 
+@functools.lru_cache(maxsize=None)
+def _load_font(size):
+    """Load the preview font once per size, falling back to PIL's built-in font."""
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype("Arial.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
+
 class OmniParameterControls:
     @classmethod
     def INPUT_TYPES(cls):
@@ -83,26 +97,15 @@ class OmniParameterControls:
         yaw_offset,
         **kwargs,
     ):
-        # Generate views based on parameters
-        views = {}
-        yaw_step = 360.0 / yaw_steps
-
-        # Add positive pitch views
-        for i in range(yaw_steps):
-            yaw = (i * yaw_step + yaw_offset) % 360
-            if yaw > 180:
-                yaw -= 360
-            views[f"pitch_{base_pitch}_yaw_{round(yaw,1)}"] = (base_pitch, yaw)
-
-        # Add negative pitch views
-        for i in range(yaw_steps):
-            yaw = (i * yaw_step + yaw_offset) % 360
-            if yaw > 180:
-                yaw -= 360
-            views[f"pitch_{-base_pitch}_yaw_{round(yaw,1)}"] = (
-                -base_pitch,
-                yaw,
-            )
+        # Generate views based on parameters: all yaws at the positive pitch, then at the
+        # negative pitch
+        yaws = (np.arange(yaw_steps) * (360.0 / yaw_steps) + yaw_offset) % 360
+        yaws = np.where(yaws > 180, yaws - 360, yaws)
+        views = {
+            f"pitch_{pitch}_yaw_{round(yaw, 1)}": (pitch, yaw)
+            for pitch in (base_pitch, -base_pitch)
+            for yaw in yaws.tolist()
+        }
 
         params = {
             "frame_interval": frame_interval,
@@ -163,7 +166,11 @@ class OmniReconstructionNode:
                     ["low", "medium", "high", "extreme"],
                     {"default": "medium"},
                 ),
-            }
+            },
+            "optional": {
+                "vocab_tree_path": ("STRING", {"default": ""}),
+                "use_gpu": ("BOOLEAN", {"default": True}),
+            },
         }
 
     RETURN_TYPES = ("RECONSTRUCTION", "model_file")
@@ -171,7 +178,9 @@ class OmniReconstructionNode:
     FUNCTION = "run_reconstruction"
     CATEGORY = "Omnidirectional Video"
 
-    def run_reconstruction(self, omni_processed, colmap_path, quality):
+    def run_reconstruction(
+        self, omni_processed, colmap_path, quality, vocab_tree_path="", use_gpu=True
+    ):
         output_dir = Path(omni_processed["output_dir"])
         image_dir = output_dir / "pinhole_images" / "images"
         db_path = output_dir / "database.db"
@@ -183,17 +192,119 @@ class OmniReconstructionNode:
         sparse_dir.mkdir(exist_ok=True)
         dense_dir.mkdir(exist_ok=True)
 
+        # All views share the intrinsics the pinhole images were rendered with, so pass them to
+        # COLMAP instead of letting it guess them per image.
+        with open(output_dir / "pinhole_images" / "camera_params.json") as f:
+            intrinsics = json.load(f)[0]
+        if intrinsics["fx"] == intrinsics["fy"]:
+            camera_model = "SIMPLE_PINHOLE"
+            camera_params = f'{intrinsics["fx"]},{intrinsics["cx"]},{intrinsics["cy"]}'
+        else:
+            camera_model = "PINHOLE"
+            camera_params = (
+                f'{intrinsics["fx"]},{intrinsics["fy"]},{intrinsics["cx"]},{intrinsics["cy"]}'
+            )
+
+        use_gpu = "1" if use_gpu else "0"
+        if vocab_tree_path:
+            loop_detection = [
+                "--SequentialMatching.loop_detection",
+                "1",
+                "--SequentialMatching.vocab_tree_path",
+                vocab_tree_path,
+            ]
+        else:
+            loop_detection = ["--SequentialMatching.loop_detection", "0"]
+
         cmds = [
-            f'"{colmap_path}" feature_extractor --database_path "{db_path}" --image_path "{image_dir}" --ImageReader.camera_model PINHOLE --ImageReader.single_camera_per_folder 1',
-            f'"{colmap_path}" sequential_matcher --database_path "{db_path}" --SequentialMatching.loop_detection 1',
-            f'"{colmap_path}" mapper --database_path "{db_path}" --image_path "{image_dir}" --output_path "{sparse_dir}" --Mapper.ba_refine_focal_length 0 --Mapper.ba_refine_principal_point 0 --Mapper.ba_refine_extra_params 0',
+            [
+                colmap_path,
+                "feature_extractor",
+                "--database_path",
+                db_path,
+                "--image_path",
+                image_dir,
+                "--ImageReader.camera_model",
+                camera_model,
+                "--ImageReader.camera_params",
+                camera_params,
+                "--ImageReader.single_camera_per_folder",
+                "1",
+                "--SiftExtraction.use_gpu",
+                use_gpu,
+            ],
+            [
+                colmap_path,
+                "rig_configurator",
+                "--database_path",
+                db_path,
+                "--rig_config_path",
+                rig_config_path,
+            ],
+            # With the rig applied, every image of capture i is matched against all images of
+            # captures i + 2^k, which covers long-range loops on its own.
+            [
+                colmap_path,
+                "sequential_matcher",
+                "--database_path",
+                db_path,
+                "--SequentialMatching.quadratic_overlap",
+                "1",
+                "--SequentialMatching.expand_rig_images",
+                "1",
+                *loop_detection,
+                "--SiftMatching.use_gpu",
+                use_gpu,
+            ],
+            # Reconstruct clusters of the scene in parallel and run global BA less often.
+            [
+                colmap_path,
+                "hierarchical_mapper",
+                "--database_path",
+                db_path,
+                "--image_path",
+                image_dir,
+                "--output_path",
+                sparse_dir,
+                "--num_workers",
+                str(os.cpu_count()),
+                "--Mapper.ba_global_frames_ratio",
+                "1.4",
+                "--Mapper.ba_global_points_ratio",
+                "1.4",
+                "--Mapper.ba_global_max_num_iterations",
+                "30",
+                "--Mapper.ba_global_max_refinements",
+                "2",
+                "--Mapper.ba_refine_focal_length",
+                "0",
+                "--Mapper.ba_refine_principal_point",
+                "0",
+                "--Mapper.ba_refine_extra_params",
+                "0",
+                "--Mapper.ba_refine_sensor_from_rig",
+                "0",
+            ],
         ]
 
+        # Each stage reads what the previous one wrote to the database, so they run one after
+        # the other; COLMAP parallelizes within every stage.
         for cmd in cmds:
-            print(f"Executing: {cmd}")
-            ret = os.system(cmd)
+            cmd = [str(arg) for arg in cmd]
+            print(f"Executing: {' '.join(cmd)}")
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                encoding="utf-8",
+                errors="replace",
+            )
+            for line in process.stdout:
+                print(line, end="")
+            ret = process.wait()
             if ret != 0:
-                raise RuntimeError(f"Command failed with exit code {ret}: {cmd}")
+                raise RuntimeError(f"Command failed with exit code {ret}: {' '.join(cmd)}")
         # generate mesh and point cloud
         cameras, images, points3D = read_model(sparse_dir / "0")
         sparse_ply_path = sparse_dir / "0" / "sparse.ply"
@@ -262,13 +373,10 @@ class OmniPreviewNode:
     def _create_placeholder_preview(self, text):
         img = Image.new("RGB", (640, 480), (30, 30, 50))
         try:
-            from PIL import ImageDraw, ImageFont
+            from PIL import ImageDraw
 
             draw = ImageDraw.Draw(img)
-            try:
-                font = ImageFont.truetype("Arial.ttf", 40)
-            except:
-                font = ImageFont.load_default()
+            font = _load_font(40)
             text_width = draw.textlength(text, font=font)
             position = ((640 - text_width) // 2, 220)
             draw.text(position, text, fill=(200, 200, 255), font=font)
@@ -277,8 +385,6 @@ class OmniPreviewNode:
         return img
 
     def generate_preview(self, show_type="input_frame", view_yaw=0.0, view_pitch=0.0, **kwargs):
-        blank_image = self._create_placeholder_preview("No Preview Available")
-
         def to_tensor(img):
             img = img.convert("RGB").resize((640, 480))
             return torch.from_numpy(np.array(img).astype(np.float32) / 255.0)[None,]
@@ -290,7 +396,7 @@ class OmniPreviewNode:
                 image = self._create_placeholder_preview(text)
                 return (to_tensor(image),)
 
-        return (to_tensor(blank_image),)
+        return (to_tensor(self._create_placeholder_preview("No Preview Available")),)
 
 
 # NEW NODE FOR ADVANCED VISUALIZATION
@@ -322,59 +428,61 @@ class OmniAdvancedPreviewNode:
         start_index,
         enable_annotation,
     ):
-        images_to_process = []
-        if show_type == "Pinhole Images" and "pinhole_views" in omni_processed:
-            images_to_process = omni_processed["pinhole_views"]
-        elif show_type == "Panoramic Frames" and "panoramic_frames" in omni_processed:
-            images_to_process = omni_processed["panoramic_frames"]
-
-        if not images_to_process:
-            blank_image = Image.new("RGB", (256, 256), "black")
-            return (torch.from_numpy(np.array(blank_image).astype(np.float32) / 255.0)[None,],)
-
         # 分页逻辑
         end_index = start_index + max_items_to_show
-        subset = images_to_process[start_index:end_index]
 
         output_images = []
-        for item in subset:
-            if isinstance(item, dict) and "image" in item:
-                img_data = item["image"]
-            if isinstance(item, dict) and "frame" in item:
-                img_data = item["frame"]
-            if isinstance(img_data, str):
-                img_data = cv2.imread(img_data)
-                img_data = cv2.cvtColor(img_data, cv2.COLOR_BGR2RGB)
-            if img_data is None:
-                print(f"Warning: Image data is None for item {item}")
-                continue
-            pil_img = Image.fromarray(img_data)
-
-            if show_type == "Pinhole Images" and enable_annotation:
-                from PIL import ImageDraw, ImageFont
-
-                draw = ImageDraw.Draw(pil_img)
-                try:
-                    font = ImageFont.truetype("arial.ttf", 20)
-                except IOError:
-                    font = ImageFont.load_default()
-
-                text = (
-                    f"P: {item['pitch']:.1f}, Y: {item['yaw']:.1f}\n"
-                    f"Size: {item['width']}x{item['height']}\n"
-                    f"Pano Idx: {item['pano_index']}"
-                )
-
-                draw.text((10, 10), text, font=font, fill="yellow")
-
-            img_tensor = torch.from_numpy(np.array(pil_img).astype(np.float32) / 255.0)
-            output_images.append(img_tensor)
-
-        if not output_images:
-            blank_image = Image.new("RGB", (256, 256), "black")
-            return (torch.from_numpy(np.array(blank_image).astype(np.float32) / 255.0)[None,],)
-
-        return (torch.stack(output_images),)
+        annotations = None
+        if show_type == "Pinhole Images" and "pinhole_views" in omni_processed:
+            pinhole_views = omni_processed["pinhole_views"]
+            # A slice of the image array, no copy.
+            output_images = pinhole_views["images"][start_index:end_index]
+            if enable_annotation:
+                height, width = output_images.shape[1:3]
+                annotations = [
+                    [
+                        f"P: {pinhole_views['pitch'][view_id]:.1f}, "
+                        f"Y: {pinhole_views['yaw'][view_id]:.1f}",
+                        f"Size: {width}x{height}",
+                        f"Pano Idx: {pano_index}",
+                    ]
+                    for pano_index, view_id in zip(
+                        pinhole_views["pano_index"][start_index:end_index].tolist(),
+                        pinhole_views["view_id"][start_index:end_index].tolist(),
+                    )
+                ]
+        elif show_type == "Panoramic Frames" and "panoramic_frames" in omni_processed:
+            pano_frames = omni_processed["panoramic_frames"]["images"]
+            if pano_frames is None:
+                print("Warning: Panoramic frames were not kept by the processor")
+            else:
+                output_images = pano_frames[start_index:end_index]
+
+        if annotations:
+            # Draw on a copy, the images are shared with the other nodes.
+            output_images = output_images.copy()
+            for img_data, lines in zip(output_images, annotations):
+                for i, line in enumerate(lines):
+                    cv2.putText(
+                        img_data,
+                        line,
+                        (10, 30 + 24 * i),
+                        cv2.FONT_HERSHEY_SIMPLEX,
+                        0.6,
+                        (255, 255, 0),
+                        1,
+                        cv2.LINE_AA,
+                    )
+
+        if len(output_images) == 0:
+            return (torch.zeros((1, 256, 256, 3)),)
+
+        # Convert straight from uint8 into one float32 batch instead of going through a float
+        # copy of every image.
+        batch = torch.empty((len(output_images), *output_images[0].shape), dtype=torch.float32)
+        for i, img_data in enumerate(output_images):
+            batch[i].copy_(torch.from_numpy(img_data))
+        return (batch.div_(255.0),)
 
 
 # UPDATE THE NODE MAPPINGS
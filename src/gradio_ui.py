@@ -1,3 +1,4 @@
+import tempfile
 import time
 from pathlib import Path
 
@@ -24,8 +25,10 @@ class OmniConverterUI:
                     # Video input
                     video_input = gr.File(label="Upload Video", type="filepath")
 
-                    # Submit button
-                    submit_btn = gr.Button("Convert", variant="primary")
+                    # Submit buttons
+                    with gr.Row():
+                        preview_btn = gr.Button("Preview")
+                        submit_btn = gr.Button("Convert", variant="primary")
 
                     # Frame extraction settings
                     with gr.Accordion("Frame Extraction", open=True):
@@ -130,22 +133,24 @@ class OmniConverterUI:
                 outputs=[views_state, view_state_display],
             )
 
+            conversion_inputs = [
+                video_input,
+                frame_interval,
+                fx,
+                fy,
+                cx,
+                cy,
+                image_width,
+                image_height,
+                fov_h,
+                fov_v,
+                views_state,
+            ]
+            preview_btn.click(
+                fn=self._run_preview, inputs=conversion_inputs, outputs=output_gallery
+            )
             submit_btn.click(
-                fn=self._run_conversion,
-                inputs=[
-                    video_input,
-                    frame_interval,
-                    fx,
-                    fy,
-                    cx,
-                    cy,
-                    image_width,
-                    image_height,
-                    fov_h,
-                    fov_v,
-                    views_state,
-                ],
-                outputs=output_gallery,
+                fn=self._run_conversion, inputs=conversion_inputs, outputs=output_gallery
             )
 
         return demo
@@ -157,6 +162,18 @@ class OmniConverterUI:
 
     def _run_conversion(self, video_file, *params):
         """Run conversion with progress tracking"""
+        output_dir = Path.cwd() / "outputs" / time.strftime("%Y%m%d%H%M%S")
+        return self._convert(video_file, params, output_dir)
+
+    def _run_preview(self, video_file, *params):
+        """Convert only the first frames, enough to fill the gallery"""
+        num_views = max(len(params[-1]), 1)
+        max_frames = -(-self.max_gallery_items // num_views)
+        with tempfile.TemporaryDirectory(prefix="omni_preview_") as output_dir:
+            return self._convert(video_file, params, output_dir, max_frames)
+
+    def _convert(self, video_file, params, output_dir, max_frames=None):
+        """Run the processor with the UI parameters and build the gallery update"""
         param_names = [
             "frame_interval",
             "fx",
@@ -170,19 +187,27 @@ class OmniConverterUI:
             "views",
         ]
         params_dict = dict(zip(param_names, params))
+        # Only the pinhole views are shown, so the decoded panoramas need not be kept around.
+        params_dict["keep_pano_frames"] = False
 
         self.processor.set_params(params_dict)
 
-        output_dir = Path.cwd() / "outputs" / time.strftime("%Y%m%d%H%M%S")
-        output_dir.mkdir(parents=True, exist_ok=True)
-        pano_images, pinhole_images_data = self.processor.process_video(video_file.name, output_dir)
+        pano_images, pinhole_images_data = self.processor.process_video(
+            video_file.name, output_dir, max_frames
+        )
+        # Only the views shown in the gallery are converted from BGR.
+        gallery = slice(self.max_gallery_items)
         image_list_for_gallery = [
             (
-                Image.fromarray(cv2.cvtColor(img_info["image"], cv2.COLOR_BGR2RGB)),
-                "Frame {}, View: {}".format(img_info["pano_index"], img_info["view_name"]),
+                Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)),
+                "Frame {}, View: {}".format(pano_index, pinhole_images_data["view_names"][view_id]),
+            )
+            for image, pano_index, view_id in zip(
+                pinhole_images_data["images"][gallery],
+                pinhole_images_data["pano_index"][gallery].tolist(),
+                pinhole_images_data["view_id"][gallery].tolist(),
             )
-            for img_info in pinhole_images_data
-        ][: self.max_gallery_items]
+        ]
         if not image_list_for_gallery:
             return gr.update(value=[], visible=False)
         return gr.update(columns=len(params_dict["views"]), value=image_list_for_gallery)
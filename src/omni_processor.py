@@ -1,18 +1,204 @@
+import functools
 import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from itertools import islice
 from pathlib import Path
+from queue import Empty, Queue
 
 import cv2
 import numpy as np
-import py360convert
 import torch
 from scipy.spatial.transform import Rotation as R
 from tqdm import tqdm
 
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from turbojpeg import TJFLAG_FASTDCT, TurboJPEG
+
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG or the libjpeg-turbo library itself is not installed.
+    turbo_jpeg = None
+
+# Same quality as the cv2.imwrite default.
+JPEG_QUALITY = 95
+# Saved panoramas are only for inspection and come from lossy video anyway.
+PANO_JPEG_QUALITY = 85
+# About 2.5 MB each for 640x640 views.
+MAX_CACHED_GRIDS = 64
+# x264's default keyframe interval; sparser frames are reached by seeking.
+SEEK_MIN_FRAME_INTERVAL = 250
+# Frames of a video tensor held on the GPU while earlier ones are still being rendered.
+MAX_GPU_FRAMES_IN_FLIGHT = 2
+
+
+def write_json(path, obj):
+    """Write ``obj`` as indented JSON, with orjson if it is installed."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+        return
+    with open(path, "w") as f:
+        json.dump(obj, f, indent=2)
+
 
 def compute_focal_length(image_size, fov_deg):
     return (image_size / 2) / np.tan(np.deg2rad(fov_deg) / 2)
 
 
+def euler_yx_to_quat(yaw_deg, pitch_deg):
+    """Quaternions (w, x, y, z) of ``R.from_euler("yx", [yaw, pitch], degrees=True)``.
+
+    Works on arrays of angles: a yaw about Y followed by a pitch about the fixed X axis.
+    """
+    half_yaw = np.deg2rad(yaw_deg) / 2
+    half_pitch = np.deg2rad(pitch_deg) / 2
+    cy, sy = np.cos(half_yaw), np.sin(half_yaw)
+    cp, sp = np.cos(half_pitch), np.sin(half_pitch)
+    return np.stack([cp * cy, sp * cy, cp * sy, sp * sy], axis=-1)
+
+
+def quat_multiply(q1, q2):
+    """Hamilton product of (w, x, y, z) quaternions, broadcast over leading axes."""
+    w1, x1, y1, z1 = np.moveaxis(q1, -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(q2, -1, 0)
+    return np.stack(
+        [
+            w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+            w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+            w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+            w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+        ],
+        axis=-1,
+    )
+
+
+def write_jpeg(path, image, quality=JPEG_QUALITY, fast_dct=False):
+    """Encode a BGR image as JPEG and write it to ``path``.
+
+    ``fast_dct`` trades some accuracy for speed and is only honored by libjpeg-turbo.
+    """
+    if turbo_jpeg is None:
+        _, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    else:
+        data = turbo_jpeg.encode(image, quality=quality, flags=TJFLAG_FASTDCT if fast_dct else 0)
+    write_bytes(path, data)
+
+
+def write_bytes(path, data):
+    """Write a bytes-like object to ``path``."""
+    # The whole file is in memory already, so hand it to the kernel without going through a
+    # buffered file object.
+    data = memoryview(data).cast("B")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        while data:
+            data = data[os.write(fd, data) :]
+    finally:
+        os.close(fd)
+
+
+def grow_array(array, length):
+    """Return a copy of ``array`` with room for ``length`` entries along the first axis."""
+    grown = np.empty((length, *array.shape[1:]), dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+@functools.lru_cache(maxsize=None)
+def load_gpu_jpeg_encoder(device):
+    """Return torchvision's ``encode_jpeg`` if it encodes a list of tensors on ``device``.
+
+    torchvision is only imported here, so CPU-only runs never load it.
+    """
+    try:
+        from torchvision.io import encode_jpeg
+    except ImportError:
+        return None
+    try:
+        # Batched and CUDA encoding need a recent torchvision.
+        encode_jpeg([torch.zeros((3, 8, 8), dtype=torch.uint8, device=device)])
+    except (TypeError, RuntimeError):
+        return None
+    return encode_jpeg
+
+
+def prefetch_iter(iterable, maxsize=8):
+    """Iterate ``iterable`` on a background thread, staying up to ``maxsize`` items ahead."""
+    queue = Queue(maxsize=maxsize)
+    stop = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    break
+                queue.put((item, None))
+        except Exception as e:
+            queue.put((end, e))
+            return
+        queue.put((end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        # Unblock the producer if it is waiting on a full queue.
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+
+def compute_e2p_maps(pano_hw, fov_deg, yaw_deg, pitch_deg, out_hw):
+    """Compute the equirectangular sampling grid of a pinhole view for ``cv2.remap``.
+
+    Follows the conventions of ``py360convert.e2p``: positive yaw looks right and positive
+    pitch looks up.
+    """
+    pano_h, pano_w = pano_hw
+    out_h, out_w = out_hw
+    x_max = np.tan(np.deg2rad(fov_deg[0]) / 2)
+    y_max = np.tan(np.deg2rad(fov_deg[1]) / 2)
+
+    # Rays in camera frame (X right, Y up, Z forward), rotated by pitch then yaw. The rotation
+    # is applied by broadcasting a row and a column term instead of building the full ray grid.
+    rotation = R.from_euler("xy", [-pitch_deg, yaw_deg], degrees=True).as_matrix()
+    rotation = rotation.astype(np.float32)
+    u = np.linspace(-x_max, x_max, out_w, dtype=np.float32)
+    v = np.linspace(y_max, -y_max, out_h, dtype=np.float32)[:, None]
+    x, y, z = (rotation[i, 0] * u + (rotation[i, 1] * v + rotation[i, 2]) for i in range(3))
+
+    lon = np.arctan2(x, z)
+    lat = np.arctan2(y, np.hypot(x, z))
+    map_x = (lon / (2 * np.pi) + 0.5) * pano_w - 0.5
+    # Columns wrap around at the seam, rows are clamped at the poles.
+    map_y = np.clip((0.5 - lat / np.pi) * pano_h - 0.5, 0, pano_h - 1)
+    return map_x.astype(np.float32), map_y.astype(np.float32)
+
+
 class OmniVideoProcessor:
     default_params = {
         "fx": 320.0,
@@ -24,6 +210,8 @@ class OmniVideoProcessor:
         "fov_h": 90,
         "fov_v": 90,
         "frame_interval": 24,
+        "save_pano_jpegs": False,
+        "keep_pano_frames": True,
         "num_steps_yaw": 4,
         "pitches_deg": [-35.0, 35.0],
         "views": {
@@ -40,106 +228,341 @@ class OmniVideoProcessor:
 
     def __init__(self, params={}):
         self.params = params if params else self.default_params.copy()
-        self.ref_sensor = list(self.params["views"].keys())[0]
+        self.device = torch.device("cuda") if torch.cuda.is_available() else None
+        # nvJPEG encoder for views rendered on the GPU, None to encode them with write_jpeg.
+        self._encode_jpeg = None
+        if self.device is not None:
+            self._encode_jpeg = load_gpu_jpeg_encoder(self.device)
+        # Fixed-point remap tables keyed by view, FOV, output and panorama size. They only
+        # depend on the key, so they are kept across set_params() calls.
+        self._grid_cache = {}
+        # The tables of the current views stacked for one remap per frame, with their key.
+        self._stacked_grid = None
+        # Frames are projected from several threads; the caches are filled under this lock.
+        self._grid_lock = threading.Lock()
+        # GPU projections all run on the default stream, so running them one at a time loses
+        # nothing and keeps a single set of temporaries in device memory.
+        self._gpu_lock = threading.Lock()
+        # Bilinear gather indices and weights of all views per panorama size, kept on the GPU.
+        self._grids = {}
+        self._update_view_params()
 
     def set_params(self, params):
         self.params = params
+        self._grids = {}
+        self._update_view_params()
+
+    def _update_view_params(self):
+        """Derive the intrinsics and view rotations shared by every frame."""
+        views = self.params["views"]
+        self.fx = compute_focal_length(self.params["width"], self.params["fov_h"])
+        self.fy = compute_focal_length(self.params["height"], self.params["fov_v"])
+        if not views:
+            self.ref_sensor = None
+            self._view_meta = {}
+            return
+        self.ref_sensor = list(views.keys())[0]
 
-    def process_video(self, video_or_path, output_dir):
+        # COLMAP: X right, Y down, Z forward. Euler: yaw, pitch, roll
+        pitch_yaw = np.array(list(views.values()), dtype=np.float64).reshape(-1, 2)
+        q_views_world = euler_yx_to_quat(pitch_yaw[:, 1], pitch_yaw[:, 0])
+        # Cam from Rig: inverse of the view rotation composed with the reference one.
+        q_world_views = q_views_world * [1, -1, -1, -1]
+        qvecs_colmap = quat_multiply(q_world_views, q_views_world[0]).tolist()
+
+        # Everything written per image that only depends on the view.
+        self._view_meta = {
+            view_name: {
+                "camera_params": {
+                    "image_prefix": view_name,
+                    "fx": self.fx,
+                    "fy": self.fy,
+                    "cx": self.params["width"] / 2,
+                    "cy": self.params["height"] / 2,
+                    "height": self.params["height"],
+                    "width": self.params["width"],
+                    "fov_h": self.params["fov_h"],
+                    "fov_v": self.params["fov_v"],
+                    "yaw": yaw,
+                    "pitch": pitch,
+                },
+                "ref_sensor": view_name == self.ref_sensor,
+                "cam_from_rig_rotation": qvec_colmap,
+            }
+            for (view_name, (pitch, yaw)), qvec_colmap in zip(views.items(), qvecs_colmap)
+        }
+
+    def process_video(self, video_or_path, output_dir, max_frames=None):
+        """Project the kept frames of a video; ``max_frames`` stops after that many of them."""
         output_dir = Path(output_dir)
         output_dir.mkdir(parents=True, exist_ok=True)
 
         if isinstance(video_or_path, str):
             video_file = Path(video_or_path)
-            video = cv2.VideoCapture(str(video_file))
-            if not video.isOpened():
-                raise IOError(f"Cannot open video file: {video_file}")
-            pano_images = self._extract_frames(video, output_dir)
-            video.release()
+            # PyAV decodes every frame, OpenCV can seek to sparse ones.
+            if av is not None and self.params["frame_interval"] < SEEK_MIN_FRAME_INTERVAL:
+                try:
+                    video = av.open(str(video_file))
+                except av.FFmpegError as e:
+                    raise IOError(f"Cannot open video file: {video_file}") from e
+                frame_count = video.streams.video[0].frames
+                frames = self._extract_frames_av(video)
+                release = video.close
+            else:
+                # Let FFmpeg decode on the GPU (NVDEC, VA-API, D3D11, ...) when the build
+                # supports it; it falls back to software decoding otherwise.
+                video = cv2.VideoCapture(
+                    str(video_file),
+                    cv2.CAP_FFMPEG,
+                    [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY],
+                )
+                if not video.isOpened():
+                    video = cv2.VideoCapture(str(video_file))
+                if not video.isOpened():
+                    raise IOError(f"Cannot open video file: {video_file}")
+                frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+                frames = self._extract_frames(video, output_dir)
+                release = video.release
+
+            # Frames are decoded on a background thread while the previous ones are projected.
+            try:
+                with closing(prefetch_iter(islice(frames, max_frames))) as prefetched:
+                    pano_images, pinhole_images_data = self._project_frame_batch(
+                        prefetched, output_dir, frame_count, max_frames
+                    )
+            finally:
+                # The prefetch thread has stopped by now, so the extractor can be finalized
+                # here, before its capture is released.
+                frames.close()
+                release()
         elif isinstance(video_or_path, torch.Tensor) or isinstance(video_or_path, np.ndarray):
-            pano_images = self._extract_frames_torch(video_or_path)
+            if max_frames is not None:
+                video_or_path = video_or_path[: max_frames * self.params["frame_interval"]]
+            pano_images, pinhole_images_data = self._project_frame_batch(
+                self._extract_frames_torch(video_or_path), output_dir, len(video_or_path)
+            )
         else:
             raise ValueError("video_or_path must be a string or Path object")
 
-        pinhole_images_data = self._generate_pinhole_images(pano_images, output_dir)
         return pano_images, pinhole_images_data
 
+    def _project_frame_batch(self, frames, output_dir, frame_count, max_frames=None):
+        """Project ``frames`` of a video with ``frame_count`` frames, at most ``max_frames``."""
+        num_panos = -(-frame_count // self.params["frame_interval"])
+        if max_frames is not None:
+            num_panos = min(num_panos, max_frames)
+        return self._generate_pinhole_images(frames, output_dir, num_panos)
+
     def _extract_frames(self, video, output_dir):
+        """Yield the kept frames of an OpenCV capture."""
         frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-        pano_images = []
+        frame_interval = self.params["frame_interval"]
+
+        if frame_interval >= SEEK_MIN_FRAME_INTERVAL:
+            # Seeking decodes again from the preceding keyframe, which only pays off when kept
+            # frames are further apart than a typical keyframe interval.
+            for frame_idx in range(0, frame_count, frame_interval):
+                if frame_idx > 0 and not video.set(cv2.CAP_PROP_POS_FRAMES, frame_idx):
+                    break
+                ret, frame = video.read()
+                if not ret:
+                    break
+                yield {"image": frame, "idx": frame_idx}
+            return
 
-        for frame_idx in tqdm(range(frame_count), desc="Extracting Frames"):
-            ret, frame = video.read()
-            if not ret:
+        for frame_idx in range(frame_count):
+            # Skipped frames are only decoded; the BGR conversion and copy of retrieve() is
+            # limited to the frames that are kept.
+            if not video.grab():
                 break
+            if frame_idx % frame_interval == 0:
+                ret, frame = video.retrieve()
+                if not ret:
+                    break
+                yield {"image": frame, "idx": frame_idx}
+
+    def _extract_frames_av(self, container):
+        """Same as ``_extract_frames``, decoding a PyAV container.
+
+        Every frame still has to go through the decoder, but only the kept ones are converted
+        from the decoder's YUV straight to BGR by libswscale.
+        """
+        stream = container.streams.video[0]
+        # Decode several frames in parallel instead of slice threading only.
+        stream.thread_type = "AUTO"
+        for frame_idx, frame in enumerate(container.decode(stream)):
             if frame_idx % self.params["frame_interval"] == 0:
-                pano_images.append({"image": frame, "idx": frame_idx})
-        return pano_images
+                yield {"image": frame.to_ndarray(format="bgr24"), "idx": frame_idx}
 
     def _extract_frames_torch(self, video_tensor):
+        """Yield the kept frames of a video tensor.
+
+        With a GPU, frames are converted there and yielded as a uint8 device tensor under
+        "tensor" only, so projecting them needs no second upload and no host copy.
+        """
         if not isinstance(video_tensor, torch.Tensor):
             raise ValueError("video_tensor must be a torch.Tensor")
 
-        pano_images = []
-        num_frames = video_tensor.shape[0]
-
-        for frame_idx in tqdm(range(num_frames), desc="Extracting Frames"):
-            if frame_idx % self.params["frame_interval"] == 0:
-                # Assuming video_tensor is normalized [0, 1], rgb mode
-                img = video_tensor[frame_idx].numpy() * 255.0
-                img = img.astype(np.uint8)  # Convert to uint8
-                pano_images.append({"image": img, "idx": frame_idx})
-
-        return pano_images
+        # Assuming video_tensor is normalized [0, 1], rgb mode
+        frame_indices = range(0, video_tensor.shape[0], self.params["frame_interval"])
+        if self.device is not None:
+            for frame_idx in frame_indices:
+                img = (video_tensor[frame_idx].to(self.device) * 255.0).clamp_(0, 255)
+                yield {"image": None, "idx": frame_idx, "tensor": img.to(torch.uint8)}
+            return
 
-    def _generate_pinhole_images(self, pano_images, output_dir):
+        # Quantize the kept frames into one uint8 array, a few frames at a time to bound the
+        # float temporaries.
+        sampled = video_tensor[:: self.params["frame_interval"]]
+        images = torch.empty(sampled.shape, dtype=torch.uint8)
+        for start in range(0, len(sampled), 16):
+            images[start : start + 16].copy_(sampled[start : start + 16].mul(255.0).clamp_(0, 255))
+        for frame_idx, img in zip(frame_indices, images.numpy()):
+            yield {"image": img, "idx": frame_idx}
+
+    def _generate_pinhole_images(self, pano_images, output_dir, num_panos=None):
+        """Project and save all views of ``pano_images``, which may be any iterable of frames
+        when ``num_panos`` estimates its length.
+
+        Returns the panoramas as ``{"images", "idx"}`` arrays, which stay empty unless
+        ``keep_pano_frames`` is set, and the pinhole views.
+        """
         output_pinhole_dir = output_dir / "pinhole_images" / "images"
         output_pinhole_dir.mkdir(parents=True, exist_ok=True)
-
-        pinhole_data = []
+        save_dirs = [output_pinhole_dir / view_name for view_name in self.params["views"]]
+        for save_dir in save_dirs:
+            save_dir.mkdir(exist_ok=True)
+        # Panoramas are kept in memory only, unless they are asked for on disk.
+        output_pano_dir = None
+        if self.params.get("save_pano_jpegs", False):
+            output_pano_dir = output_dir / "pano_images"
+            output_pano_dir.mkdir(parents=True, exist_ok=True)
+
+        if num_panos is None:
+            num_panos = len(pano_images)
+        views = self.params["views"]
+        num_views = len(views)
+        # Without keeping the panoramas, only the frames queued for decoding and rendering are
+        # held in memory.
+        keep_pano_frames = self.params.get("keep_pano_frames", True)
+        pano_frames = None
+        pano_indices = []
         camera_params_list = []
         camera_rig_params = {}
-        pinhole_views = []
-
-        for pano_info in tqdm(pano_images, desc="Generating Pinhole Views"):
-            pano_idx, pano_image = pano_info["idx"], pano_info["image"]
-            for view_name, (pitch, yaw) in self.params["views"].items():
-                pinhole_image = self._convert_to_pinhole(pano_image, pitch, yaw)
-
-                save_dir = output_pinhole_dir / view_name
-                save_dir.mkdir(parents=True, exist_ok=True)
-                save_path = save_dir / f"{pano_idx:06d}.jpg"
-                cv2.imwrite(str(save_path), pinhole_image)
-
-                h, w = pinhole_image.shape[:2]
-                pinhole_views.append(
-                    {
-                        "image": pinhole_image,
-                        "pano_index": pano_idx,
-                        "view_name": view_name,
-                        "pitch": pitch,
-                        "yaw": yaw,
-                        "width": w,
-                        "height": h,
-                        "save_path": str(save_path),
-                    }
-                )
-
-                pinhole_data.append((pano_idx, view_name, pinhole_image, str(save_path)))
 
-                is_ref = view_name == self.ref_sensor
-                cam_params = self._create_camera_params(
-                    save_path, pano_idx, view_name, pitch, yaw, is_ref
-                )
-                camera_params_list.append(cam_params)
+        # The views are returned as one array per field; entry k holds view k % num_views of
+        # panorama k // num_views.
+        images = np.empty(
+            (
+                num_panos * num_views,
+                int(self.params["height"]),
+                int(self.params["width"]),
+                3,
+            ),
+            dtype=np.uint8,
+        )
 
-                if view_name not in camera_rig_params:
-                    camera_rig_params[view_name] = {
-                        "image_prefix": view_name,
-                        "yaw": yaw,
-                        "pitch": pitch,
-                        "ref_sensor": is_ref,
-                    }
+        # Frames are projected and their views encoded on a thread pool, so consecutive frames
+        # are processed in parallel; OpenCV, torch and libjpeg-turbo all release the GIL. The
+        # number of frames in flight is bounded to keep decoded frames from piling up.
+        num_workers = os.cpu_count()
+        write_jobs = []
+        in_flight = threading.BoundedSemaphore(2 * num_workers)
+        # Frames already on the GPU are bounded separately, whatever the number of CPU workers.
+        gpu_in_flight = threading.BoundedSemaphore(MAX_GPU_FRAMES_IN_FLIGHT)
+        # Set by the first failed job, so that no further frames are fed to the pool.
+        failed = threading.Event()
+
+        def run(job, *args):
+            try:
+                job(*args)
+            except BaseException:
+                failed.set()
+                raise
+
+        def render(pano_source, pinhole_images, save_paths):
+            try:
+                run(self._render_views, pano_source, pinhole_images, save_paths)
+            finally:
+                in_flight.release()
+                if isinstance(pano_source, torch.Tensor):
+                    gpu_in_flight.release()
+
+        # Leaving the pool waits for the running jobs, so none of them is still writing into
+        # ``images`` once an error reaches the caller.
+        with ThreadPoolExecutor(max_workers=num_workers) as writer:
+            # Redraw the progress bar at most twice a second; without a TTY every refresh is a
+            # write to the captured log.
+            progress = tqdm(
+                pano_images,
+                total=num_panos or None,
+                desc="Generating Pinhole Views",
+                mininterval=0.5,
+            )
+            for i, pano_info in enumerate(progress):
+                if failed.is_set():
+                    # Report the failure below instead of rendering the rest of the video. Queued
+                    # jobs are cancelled one by one, shutdown(cancel_futures=True) needs 3.9.
+                    for job in write_jobs:
+                        job.cancel()
+                    break
+                pano_idx, pano_image = pano_info["idx"], pano_info["image"]
+                # Frames that are already on the GPU are projected from there; only one of them
+                # is kept alive at a time.
+                pano_source = pano_info.pop("tensor", pano_image)
+                if pano_image is None and (keep_pano_frames or output_pano_dir is not None):
+                    # The host copy of a GPU frame is only made for keeping or saving it.
+                    pano_image = pano_source.cpu().numpy()
+                pano_indices.append(pano_idx)
+                if keep_pano_frames:
+                    if pano_frames is None:
+                        pano_frames = np.empty((max(num_panos, 1), *pano_image.shape), np.uint8)
+                    elif i == len(pano_frames):
+                        pano_frames = grow_array(pano_frames, 2 * (i + 1))
+                    pano_frames[i] = pano_image
+                if (i + 1) * num_views > len(images):
+                    # The video has more frames than its header reported. Pending frames are
+                    # rendered into the current array, so let them finish before copying it.
+                    for job in write_jobs:
+                        job.result()
+                    images = grow_array(images, 2 * (i + 1) * num_views)
+                if output_pano_dir is not None:
+                    write_jobs.append(
+                        writer.submit(
+                            run,
+                            write_jpeg,
+                            output_pano_dir / f"{pano_idx:06d}.jpg",
+                            pano_image,
+                            PANO_JPEG_QUALITY,
+                            True,
+                        )
+                    )
+                save_paths = []
+                for (view_name, (pitch, yaw)), save_dir in zip(views.items(), save_dirs):
+                    save_path = save_dir / f"{pano_idx:06d}.jpg"
+                    save_paths.append(save_path)
+
+                    is_ref = self._view_meta[view_name]["ref_sensor"]
+                    camera_params_list.append(
+                        self._create_camera_params(save_path, pano_idx, view_name)
+                    )
+
+                    if view_name not in camera_rig_params:
+                        camera_rig_params[view_name] = {
+                            "image_prefix": view_name,
+                            "yaw": yaw,
+                            "pitch": pitch,
+                            "ref_sensor": is_ref,
+                        }
+
+                in_flight.acquire()
+                if isinstance(pano_source, torch.Tensor):
+                    gpu_in_flight.acquire()
+                pinhole_images = images[i * num_views : (i + 1) * num_views]
+                write_jobs.append(writer.submit(render, pano_source, pinhole_images, save_paths))
+        for job in write_jobs:
+            if not job.cancelled():
+                job.result()
 
         self._save_camera_params(
             camera_params_list,
@@ -149,77 +572,179 @@ class OmniVideoProcessor:
             camera_rig_params, output_dir / "pinhole_images" / "rig_config.json"
         )
 
-        return pinhole_views
-
-    def _convert_to_pinhole(self, pano_image, pitch, yaw):
-        return py360convert.e2p(
-            e_img=pano_image,
-            fov_deg=(self.params["fov_h"], self.params["fov_v"]),
-            u_deg=yaw,
-            v_deg=pitch,
-            out_hw=(self.params["height"], self.params["width"]),
-            in_rot_deg=0,
-            mode="bilinear",
+        pano_indices = np.array(pano_indices, dtype=np.int32)
+        panos = {
+            "images": pano_frames[: len(pano_indices)] if pano_frames is not None else None,
+            "idx": pano_indices if pano_frames is not None else pano_indices[:0],
+        }
+        return panos, {
+            "images": images[: len(pano_indices) * num_views],
+            "pano_index": np.repeat(pano_indices, num_views),
+            "view_id": np.tile(np.arange(num_views, dtype=np.int32), len(pano_indices)),
+            # Per view, indexed by view_id.
+            "view_names": list(views),
+            "pitch": np.array([pitch for pitch, _ in views.values()], dtype=np.float64),
+            "yaw": np.array([yaw for _, yaw in views.values()], dtype=np.float64),
+            "image_dir": str(output_pinhole_dir),
+        }
+
+    def _render_views(self, pano_image, out, save_paths):
+        """Project a panorama to all views into ``out`` and save them as JPEG."""
+        if not self.params["views"]:
+            return
+        encode_jpeg = self._encode_jpeg
+        if encode_jpeg is None:
+            self._project_views(pano_image, out)
+            for pinhole_image, save_path in zip(out, save_paths):
+                write_jpeg(save_path, pinhole_image)
+            return
+
+        # Encode with nvJPEG while the views are still on the GPU. The views are BGR like the
+        # ones write_jpeg gets, torchvision expects RGB. Only the file writes run outside the
+        # GPU lock.
+        with self._gpu_lock:
+            pinhole = self._project_views_torch(pano_image)
+            out[...] = pinhole.cpu().numpy()
+            try:
+                encoded = encode_jpeg(
+                    list(pinhole.flip(-1).permute(0, 3, 1, 2).contiguous()), quality=JPEG_QUALITY
+                )
+                encoded = [data.cpu().numpy() for data in encoded]
+            except (TypeError, RuntimeError):
+                # Encode on the CPU for the rest of the run.
+                self._encode_jpeg = None
+                encoded = None
+            del pinhole
+        if encoded is None:
+            for pinhole_image, save_path in zip(out, save_paths):
+                write_jpeg(save_path, pinhole_image)
+            return
+        for data, save_path in zip(encoded, save_paths):
+            write_bytes(save_path, data)
+
+    def _project_views(self, pano_image, out):
+        """Project a panorama to all views, in the order of ``self.params["views"]``, into
+        ``out``."""
+        if self.device is not None:
+            with self._gpu_lock:
+                out[...] = self._project_views_torch(pano_image).cpu().numpy()
+            return
+        # The tables of all views are stacked vertically, so a single remap renders every view
+        # straight into ``out`` seen as one (V * H, W) image.
+        key = (
+            tuple(self.params["views"].values()),
+            (self.params["fov_h"], self.params["fov_v"]),
+            (self.params["height"], self.params["width"]),
+            pano_image.shape[:2],
+        )
+        with self._grid_lock:
+            if self._stacked_grid is None or self._stacked_grid[0] != key:
+                grids = [
+                    self._view_grid(pano_image.shape[:2], pitch, yaw)
+                    for pitch, yaw in self.params["views"].values()
+                ]
+                map1 = np.concatenate([grid[0] for grid in grids])
+                map2 = np.concatenate([grid[1] for grid in grids])
+                self._stacked_grid = (key, map1, map2)
+            _, map1, map2 = self._stacked_grid
+        cv2.remap(
+            pano_image,
+            map1,
+            map2,
+            cv2.INTER_LINEAR,
+            dst=out.reshape(-1, *out.shape[2:]),
+            borderMode=cv2.BORDER_WRAP,
         )
 
-    def _create_camera_params(
-        self, save_path: Path, pano_idx, view_name, pitch, yaw, ref_sensor=None
-    ):
-        fx = compute_focal_length(self.params["width"], self.params["fov_h"])
-        fy = compute_focal_length(self.params["height"], self.params["fov_v"])
+    def _project_views_torch(self, pano_image):
+        pano_h, pano_w = pano_image.shape[:2]
+        key = (pano_h, pano_w)
+        with self._grid_lock:
+            if key not in self._grids:
+                map_x, map_y = zip(
+                    *(
+                        compute_e2p_maps(
+                            key,
+                            (self.params["fov_h"], self.params["fov_v"]),
+                            yaw,
+                            pitch,
+                            (self.params["height"], self.params["width"]),
+                        )
+                        for pitch, yaw in self.params["views"].values()
+                    )
+                )
+                # Sample positions in a panorama padded with one wrapped column on each side and one
+                # repeated row at the bottom, so the other three bilinear taps are always in bounds.
+                map_x, map_y = np.stack(map_x) + 1, np.stack(map_y)
+                x0, y0 = np.floor(map_x), np.floor(map_y)
+                # Pixel offsets into the padded panorama fit in int32, which halves the index
+                # traffic of the gathers compared to int64.
+                index = (y0 * (pano_w + 2) + x0).astype(np.int32)
+                weights = np.stack([map_x - x0, map_y - y0])[..., None]
+                # Only the fractional weights are stored in fp16, the positions stay exact.
+                self._grids[key] = (
+                    torch.from_numpy(index.ravel()).to(self.device),
+                    torch.from_numpy(weights).to(self.device, torch.float16),
+                )
+            index, (weight_x, weight_y) = self._grids[key]
+
+        # The panorama is uploaded and padded as uint8 and only the gathered taps are converted.
+        pano = torch.as_tensor(pano_image, device=self.device)
+        pano = torch.cat([pano[:, -1:], pano, pano[:, :1]], dim=1)
+        pano = torch.cat([pano, pano[-1:]], dim=0).reshape(-1, 3)
+        row = pano_w + 2
+
+        def tap(offset):
+            return pano.index_select(0, index + offset).view(weight_x.shape[:-1] + (3,)).half()
+
+        top = torch.lerp(tap(0), tap(1), weight_x)
+        bottom = torch.lerp(tap(row), tap(row + 1), weight_x)
+        pinhole = torch.lerp(top, bottom, weight_y)
+        return pinhole.round_().clamp_(0, 255).to(torch.uint8)
+
+    def _view_grid(self, pano_hw, pitch, yaw):
+        """Return the fixed-point remap tables of a view for the current FOV and size.
+
+        Must be called with ``_grid_lock`` held.
+        """
+        fov = (self.params["fov_h"], self.params["fov_v"])
+        out_hw = (self.params["height"], self.params["width"])
+        key = (pitch, yaw, fov, out_hw, pano_hw)
+        if key not in self._grid_cache:
+            if len(self._grid_cache) >= MAX_CACHED_GRIDS:
+                # Drop the oldest table, views of earlier parameter sets are rarely reused.
+                del self._grid_cache[next(iter(self._grid_cache))]
+            map_x, map_y = compute_e2p_maps(pano_hw, fov, yaw, pitch, out_hw)
+            self._grid_cache[key] = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        return self._grid_cache[key]
+
+    def _create_camera_params(self, save_path: Path, pano_idx, view_name):
+        view_meta = self._view_meta[view_name]
         return {
             "image_name": save_path.name,
-            "image_prefix": view_name,
-            "fx": fx,
-            "fy": fy,
-            "cx": self.params["width"] / 2,
-            "cy": self.params["height"] / 2,
-            "height": self.params["height"],
-            "width": self.params["width"],
-            "fov_h": self.params["fov_h"],
-            "fov_v": self.params["fov_v"],
-            "yaw": yaw,
-            "pitch": pitch,
+            **view_meta["camera_params"],
             "pano_index": pano_idx,
-            "ref_sensor": ref_sensor,
+            "ref_sensor": view_meta["ref_sensor"],
         }
 
     def _save_camera_params(self, params, output_file):
-        with open(output_file, "w") as f:
-            json.dump(params, f, indent=4)
+        write_json(output_file, params)
 
     def _save_colmap_camera_rig(self, camera_rig_params, output_file):
         if not self.params["views"]:
             return
 
-        ref_view_name = list(self.params["views"].keys())[0]
-        ref_pitch, ref_yaw = self.params["views"][ref_view_name]
-
-        # COLMAP: X right, Y down, Z forward. Euler: yaw, pitch, roll
-        R_ref_world = R.from_euler("yx", [ref_yaw, ref_pitch], degrees=True)
-
         rig_cameras = []
         for image_prefix, params in camera_rig_params.items():
-            R_view_world = R.from_euler("yx", [params["yaw"], params["pitch"]], degrees=True)
-            R_view_ref = R_view_world.inv() * R_ref_world  # Cam from Rig
-
-            # Scipy quat (x,y,z,w) -> COLMAP quat (w,x,y,z)
-            qvec_scipy = R_view_ref.as_quat()
-            qvec_colmap = [
-                qvec_scipy[3],
-                qvec_scipy[0],
-                qvec_scipy[1],
-                qvec_scipy[2],
-            ]
-
             cam_entry = {"image_prefix": image_prefix}
             if params.get("ref_sensor"):
                 cam_entry["ref_sensor"] = True
             else:
-                cam_entry["cam_from_rig_rotation"] = qvec_colmap
+                cam_entry["cam_from_rig_rotation"] = self._view_meta[image_prefix][
+                    "cam_from_rig_rotation"
+                ]
                 cam_entry["cam_from_rig_translation"] = [0.0, 0.0, 0.0]
             rig_cameras.append(cam_entry)
 
         colmap_rig_config = [{"cameras": rig_cameras}]
-        with open(output_file, "w") as f:
-            json.dump(colmap_rig_config, f, indent=4)
+        write_json(output_file, colmap_rig_config)